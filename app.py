@@ -1,15 +1,21 @@
-from flask import Flask, render_template_string
+import gzip
+import hashlib
+
+from flask import Flask, Response
+from werkzeug.http import parse_accept_header, parse_etags
 
 app = Flask(__name__)
+# Static assets are linked with a content hash, so browsers may keep them for a year.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000
 
-HTML = '''
+HTML = r'''
 <!doctype html>
 <html lang="ru">
 <head>
   <meta charset="utf-8" />
   <meta name="viewport" content="width=device-width,initial-scale=1" />
   <title>WebRTC P2P — аудио чат</title>
-  <script src="https://cdn.tailwindcss.com"></script>
+  <link rel="stylesheet" href="/static/tw.css?v=__TW_CSS_VERSION__" />
 </head>
 <body class="bg-gray-50 text-gray-900 p-6 font-sans">
   <div class="max-w-3xl mx-auto">
@@ -66,7 +72,11 @@ HTML = '''
   <script>
     let pc = null;
     let localStream = null;
+    let audioTrack = null;
     const configuration = {iceServers: [{urls: 'stun:stun.l.google.com:19302'}]};
+    // Речь разборчива и на 24 кбит/с Opus в моно
+    const AUDIO_MAX_BITRATE = 24000;
+    const audioConstraints = {channelCount: 1, echoCancellation: true, noiseSuppression: true, autoGainControl: true};
 
     const remoteAudio = document.getElementById('remoteAudio');
     const startBtn = document.getElementById('startBtn');
@@ -81,9 +91,18 @@ HTML = '''
     const remoteICE = document.getElementById('remoteICE');
     const addRemoteICEBtn = document.getElementById('addRemoteICEBtn');
 
+    const localICEBuf = [];
+    let localICEFlushScheduled = false;
+
+    function flushLocalICE(){
+      localICEFlushScheduled = false;
+      localICE.value = localICEBuf.length ? localICEBuf.join('\n') + '\n' : '';
+    }
+
     startBtn.onclick = async () => {
       try {
-        localStream = await navigator.mediaDevices.getUserMedia({audio:true});
+        localStream = await navigator.mediaDevices.getUserMedia({audio: audioConstraints});
+        audioTrack = localStream.getAudioTracks()[0] || null;
         startBtn.disabled = true;
         hangupBtn.disabled = false;
         createOfferBtn.disabled = false;
@@ -97,25 +116,46 @@ HTML = '''
       pc = null;
       if(localStream) localStream.getTracks().forEach(t=>t.stop());
       localStream = null;
+      audioTrack = null;
       remoteAudio.srcObject = null;
       startBtn.disabled = false;
       hangupBtn.disabled = true;
       createOfferBtn.disabled = true;
       createAnswerBtn.disabled = true;
       localSDP.value = '';
+      localICEBuf.length = 0;
       localICE.value = '';
       remoteSDP.value = '';
       remoteICE.value = '';
     };
 
     function createPeerConnection(){
+      if(pc){
+        pc.close();
+        localICEBuf.length = 0;
+        localICE.value = '';
+      }
       pc = new RTCPeerConnection(configuration);
-      pc.onicecandidate = ev => { if(ev.candidate) localICE.value += JSON.stringify(ev.candidate)+'\n'; };
+      pc.onicecandidate = ev => {
+        if(!ev.candidate) return;
+        localICEBuf.push(JSON.stringify(ev.candidate));
+        if(!localICEFlushScheduled){ localICEFlushScheduled = true; requestAnimationFrame(flushLocalICE); }
+      };
       pc.ontrack = ev => remoteAudio.srcObject = ev.streams[0];
-      if(localStream) localStream.getTracks().forEach(track => pc.addTrack(track, localStream));
+      if(audioTrack) pc.addTrack(audioTrack, localStream);
       return pc;
     }
 
+    async function limitAudioBitrate(){
+      for(const sender of pc.getSenders()){
+        if(!sender.track || sender.track.kind !== 'audio') continue;
+        const params = sender.getParameters();
+        if(!params.encodings || !params.encodings.length) continue;
+        params.encodings[0].maxBitrate = AUDIO_MAX_BITRATE;
+        try{ await sender.setParameters(params); } catch(e){ console.warn('Не удалось ограничить битрейт:', e); }
+      }
+    }
+
     createOfferBtn.onclick = async () => {
       try {
         createPeerConnection();
@@ -125,6 +165,7 @@ HTML = '''
 
         const offer = await pc.createOffer();
         await pc.setLocalDescription(offer);
+        await limitAudioBitrate();
         localSDP.value = JSON.stringify(pc.localDescription);
         setRemoteDescBtn.disabled = false;
       } catch(e){ alert('Ошибка при создании Offer: '+e.message); }
@@ -139,6 +180,7 @@ HTML = '''
         await pc.setRemoteDescription(remoteDesc);
         const answer = await pc.createAnswer();
         await pc.setLocalDescription(answer);
+        await limitAudioBitrate();
         localSDP.value = JSON.stringify(pc.localDescription);
         setRemoteDescBtn.disabled = false;
       } catch(e){ alert('Ошибка при создании Answer: '+e.message); }
@@ -159,13 +201,15 @@ HTML = '''
       const text = remoteICE.value.trim();
       if(!text){ alert('Вставьте хотя бы один кандидат'); return; }
       const lines = text.split(/\r?\n/).map(l=>l.trim()).filter(Boolean);
-      for(const line of lines){
-        try{
-          const cand = JSON.parse(line);
-          if(!pc) createPeerConnection();
-          await pc.addIceCandidate(cand);
-        } catch(e){ console.error('Ошибка добавления кандидата:', e); alert('Смотрите консоль'); }
-      }
+      let failed = 0;
+      const cands = lines.map(line => {
+        try{ return JSON.parse(line); } catch(e){ console.error('Ошибка добавления кандидата:', e); failed++; return null; }
+      }).filter(Boolean);
+      if(!pc) createPeerConnection();
+      await Promise.all(cands.map(cand => pc.addIceCandidate(cand).catch(e => {
+        console.error('Ошибка добавления кандидата:', e); failed++;
+      })));
+      if(failed) alert('Смотрите консоль');
       remoteICE.value='';
     };
 
@@ -178,9 +222,48 @@ HTML = '''
 </html>
 '''
 
+with app.open_resource('static/tw.css') as f:
+    TW_CSS_VERSION = hashlib.sha256(f.read()).hexdigest()[:12]
+HTML = HTML.replace('__TW_CSS_VERSION__', TW_CSS_VERSION)
+
+# The page is static, so it is encoded and compressed once at import and
+# served straight from WSGI without going through Flask's request dispatch.
+INDEX_BODY = HTML.encode('utf-8')
+INDEX_ETAG = hashlib.sha256(INDEX_BODY).hexdigest()
+INDEX_GZIP_BODY = gzip.compress(INDEX_BODY, compresslevel=9, mtime=0)
+INDEX_GZIP_ETAG = INDEX_ETAG + '-gzip'
+INDEX_HEADERS = [
+    ('Content-Type', 'text/html; charset=utf-8'),
+    ('Cache-Control', 'public, max-age=60, must-revalidate'),
+    ('Vary', 'Accept-Encoding'),
+]
+
+def serve_index(wsgi_app):
+    def application(environ, start_response):
+        if environ.get('PATH_INFO') != '/' or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return wsgi_app(environ, start_response)
+
+        if parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))['gzip'] > 0:
+            body, etag = INDEX_GZIP_BODY, INDEX_GZIP_ETAG
+            headers = INDEX_HEADERS + [('Content-Encoding', 'gzip'), ('ETag', '"%s"' % etag)]
+        else:
+            body, etag = INDEX_BODY, INDEX_ETAG
+            headers = INDEX_HEADERS + [('ETag', '"%s"' % etag)]
+
+        if parse_etags(environ.get('HTTP_IF_NONE_MATCH')).contains_weak(etag):
+            start_response('304 Not Modified', headers)
+            return []
+        start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+        return [] if environ['REQUEST_METHOD'] == 'HEAD' else [body]
+    return application
+
+app.wsgi_app = serve_index(app.wsgi_app)
+
+# GET/HEAD never reach this view, but the rule keeps url_for('index'), the
+# automatic OPTIONS reply and 405 for other methods on '/'.
 @app.route('/')
 def index():
-    return render_template_string(HTML)
+    return Response(INDEX_BODY, mimetype='text/html')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)